@@ -1,39 +1,68 @@
 import javax.swing.*;
 import java.awt.*;
 import java.awt.event.*;
+import java.awt.image.BufferedImage;
 import java.io.*;
 import java.net.*;
+import java.nio.ByteBuffer;
 import java.util.Scanner;
+import java.util.concurrent.*;
 import java.util.zip.*;
 import java.beans.PropertyVetoException;
+import java.lang.reflect.InvocationTargetException;
 import javax.imageio.ImageIO;
+import javax.imageio.ImageReadParam;
+import javax.imageio.ImageReader;
+import javax.imageio.stream.ImageInputStreamImpl;
 
 
 public class Main {
     static String port = "4907";
+    static final int CONNECT_TIMEOUT_MILLIS = 10 * 1000;
 
     public static void main(String args[]) {
-        String ip = JOptionPane.showInputDialog("Please enter server ip");
-        new Main().initialize(ip, Integer.parseInt(port));
+        // Every window, including the address prompt, is built on the Swing event thread.
+        SwingUtilities.invokeLater(new Runnable() {
+            public void run() {
+                String ip = JOptionPane.showInputDialog("Please enter server ip");
+                // Cancelled or left blank: there is nothing to connect to.
+                if (ip == null || ip.trim().isEmpty()) {
+                    return;
+                }
+                new Main().initialize(ip.trim(), Integer.parseInt(port));
+            }
+        });
     }
 
+    // Runs on the Swing event thread.
     public void initialize(String ip, int port) {
-        try {
-            Socket sc = new Socket(ip, port);
-            System.out.println("Connecting to the Server");
-            Authenticate frame1 = new Authenticate(sc);
-
-            frame1.setSize(300, 80);
-            frame1.setLocation(500, 300);
-            frame1.setVisible(true);
-        } catch (Exception ex) {
-            ex.printStackTrace();
-        }
+        Authenticate frame1 = new Authenticate(ip, port);
+
+        frame1.setSize(300, 80);
+        frame1.setLocation(500, 300);
+        frame1.setVisible(true);
+    }
+
+    // The server allows only a short time between connecting and the password,
+    // so the connection is made when the password is submitted.
+    static Socket connect(String ip, int port) throws IOException {
+        Socket sc = new Socket();
+        // Input events are tiny and must not wait for Nagle; frames need a large window,
+        // which has to be requested before connecting.
+        sc.setTcpNoDelay(true);
+        sc.setReceiveBufferSize(4 * 1024 * 1024);
+        // Lets a dropped link end the session instead of leaving it waiting forever.
+        sc.setKeepAlive(true);
+        System.out.println("Connecting to the Server");
+        sc.connect(new InetSocketAddress(ip, port), CONNECT_TIMEOUT_MILLIS);
+        return sc;
     }
 }
 
 class Authenticate extends JFrame implements ActionListener {
     private Socket cSocket = null;
+    private String ip = "";
+    private int port = 0;
     DataOutputStream psswrchk = null;
     DataInputStream verification = null;
     String verify = "";
@@ -42,11 +71,12 @@ class Authenticate extends JFrame implements ActionListener {
     JLabel label, label1;
     final JTextField text1;
 
-    Authenticate(Socket cSocket) {
+    Authenticate(String ip, int port) {
         label1 = new JLabel();
         label1.setText("Password");
         text1 = new JTextField(15);
-        this.cSocket = cSocket;
+        this.ip = ip;
+        this.port = port;
 
         label = new JLabel();
         label.setText("");
@@ -68,6 +98,7 @@ class Authenticate extends JFrame implements ActionListener {
         String value1 = text1.getText();
 
         try {
+            cSocket = Main.connect(ip, port);
             psswrchk = new DataOutputStream(cSocket.getOutputStream());
             verification = new DataInputStream(cSocket.getInputStream());
             psswrchk.writeUTF(value1);
@@ -77,7 +108,10 @@ class Authenticate extends JFrame implements ActionListener {
             e.printStackTrace();
         }
 
-        if (verify.equals("valid")) {
+        if (cSocket == null) {
+            JOptionPane.showMessageDialog(this, "Could not connect to the server", "Error", JOptionPane.ERROR_MESSAGE);
+            dispose();
+        } else if (verify.equals("valid")) {
             String width = "", height = "";
             try {
                 width = verification.readUTF();
@@ -103,7 +137,8 @@ enum Commands {
     RELEASE_MOUSE(-2),
     PRESS_KEY(-3),
     RELEASE_KEY(-4),
-    MOVE_MOUSE(-5);
+    MOVE_MOUSE(-5),
+    SET_QUALITY(-6);
 
     private int abbrev;
 
@@ -116,13 +151,21 @@ enum Commands {
     }
 }
 
-class CreateFrame extends Thread {
+class CreateFrame extends Thread implements ActionListener {
     String width = "", height = "";
     private JFrame frame = new JFrame();
     private JDesktopPane desktop = new JDesktopPane();
     private Socket cSocket = null;
     private JInternalFrame interFrame = new JInternalFrame("Server Screen", true, true, true);
-    private JPanel cPanel = new JPanel();
+    private ScreenPanel cPanel = new ScreenPanel();
+    private ReceiveScreen receiver = null;
+    private SendEvents events = null;
+    // Frame counters are sampled on a timer rather than measured per frame.
+    private Timer statsTimer = new Timer(3000, this);
+    private int lastFrames = 0, lastDropped = 0;
+    // JPEG quality (percent) requested from the server.
+    private int quality = 75;
+    static final int MIN_QUALITY = 30, MAX_QUALITY = 75;
 
     public CreateFrame(Socket cSocket, String width, String height) {
 
@@ -156,7 +199,19 @@ class CreateFrame extends Thread {
 
     public void run() {
         InputStream in = null;
-        drawGUI();
+        // The window is laid out on the Swing event thread; waiting for it means
+        // the panel has its size before SendEvents reads it.
+        try {
+            SwingUtilities.invokeAndWait(new Runnable() {
+                public void run() {
+                    drawGUI();
+                }
+            });
+        } catch (InterruptedException ex) {
+            ex.printStackTrace();
+        } catch (InvocationTargetException ex) {
+            ex.printStackTrace();
+        }
 
         try {
             in = cSocket.getInputStream();
@@ -164,53 +219,309 @@ class CreateFrame extends Thread {
             ex.printStackTrace();
         }
 
-        new ReceiveScreen(in, cPanel);
-        new SendEvents(cSocket, cPanel, width, height);
+        receiver = new ReceiveScreen(in, cPanel);
+        events = new SendEvents(cSocket, cPanel, width, height);
+        statsTimer.start();
+    }
+
+    public void actionPerformed(ActionEvent ae) {
+        int frames = cPanel.frames;
+        int dropped = receiver.drawer.dropped;
+        int skipped = dropped - lastDropped;
+        int seconds = statsTimer.getDelay() / 1000;
+        interFrame.setTitle("Server Screen - " + (frames - lastFrames) / seconds + " fps, "
+                + skipped + " skipped");
+        lastFrames = frames;
+        lastDropped = dropped;
+
+        // Skipped frames were encoded and sent for nothing, so ask the server for
+        // cheaper ones; step back up once every frame is being shown again.
+        int target = skipped > 0 ? Math.max(MIN_QUALITY, quality - 10) : Math.min(MAX_QUALITY, quality + 5);
+        if (target != quality) {
+            quality = target;
+            events.sendQuality(quality);
+        }
     }
 }
 
 class ReceiveScreen extends Thread {
     private ObjectInputStream cObjectInputStream = null;
-    private JPanel cPanel = null;
+    private ScreenPanel cPanel = null;
     private boolean continueLoop = true;
-    InputStream oin = null;
-    Image image1 = null;
-
-    public ReceiveScreen(InputStream in, JPanel p) {
-        oin = in;
+    DataInputStream oin = null;
+    // Updates waiting for DrawScreen. Each one only carries the tiles that changed,
+    // so none may be dropped; when all buffers are queued, reading waits.
+    BlockingQueue<ScreenFrame> frames = new ArrayBlockingQueue<ScreenFrame>(3);
+    // Buffers not in use.
+    BlockingQueue<ScreenFrame> free = new ArrayBlockingQueue<ScreenFrame>(3);
+    DrawScreen drawer = null;
+    // Upper bound for a frame length read off the wire.
+    static final int MAX_FRAME = 64 * 1024 * 1024;
+
+    public ReceiveScreen(InputStream in, ScreenPanel p) {
+        // Buffered so the length header and the start of the frame come in one read.
+        oin = new DataInputStream(new BufferedInputStream(in, 64 * 1024));
         cPanel = p;
+        for (int i = 0; i < 3; i++) {
+            free.add(new ScreenFrame());
+        }
+        drawer = new DrawScreen(frames, free, cPanel);
+        // Reading the socket promptly keeps the server's sends from stalling.
+        setPriority(Thread.NORM_PRIORITY + 2);
         start();
     }
 
     public void run() {
         try {
             while (continueLoop) {
-                byte[] bytes = new byte[1024 * 1024];
-                int count = 0;
-                do {
-                    count += oin.read(bytes, count, bytes.length - count);
-                } while (!(count > 4 && bytes[count - 2] == (byte) -1 && bytes[count - 1] == (byte) -39));
+                // Each frame is a 4-byte length followed by that many bytes of tile update.
+                int count = oin.readInt();
+                if (count <= 0 || count > MAX_FRAME) {
+                    throw new IOException("Invalid frame length " + count);
+                }
+                ScreenFrame frame = free.take();
+                if (frame.data.length < count) {
+                    frame.data = new byte[count];
+                }
+                frame.length = count;
+                oin.readFully(frame.data, 0, count);
+                frames.put(frame);
+            }
+
+        } catch (EOFException ex) {
+            // Server closed the stream.
+        } catch (IOException ex) {
+            ex.printStackTrace();
+        } catch (InterruptedException ex) {
+            ex.printStackTrace();
+        } finally {
+            System.out.println("Skipped " + drawer.dropped + " stale frames");
+        }
+    }
+}
 
-                image1 = ImageIO.read(new ByteArrayInputStream(bytes));
-                image1 = image1.getScaledInstance(cPanel.getWidth(), cPanel.getHeight(), Image.SCALE_FAST);
+class DrawScreen extends Thread {
+    private BlockingQueue<ScreenFrame> frames = null;
+    private BlockingQueue<ScreenFrame> free = null;
+    private ScreenPanel cPanel = null;
+    private boolean continueLoop = true;
+    // Decode target for every tile, as wide as the screen and one tile high.
+    BufferedImage image1 = null;
+    ImageReader reader = null;
+    ImageReadParam param = null;
+    // Reads each tile straight out of the frame buffer.
+    TileInputStream tile = new TileInputStream();
+    // Tiles are at most this tall; it matches the server's tile size.
+    static final int TILE = 64;
+    // Full-size copy of the remote screen that tiles are drawn into.
+    BufferedImage screen = null;
+    // Decoded frames are scaled into these two panel-sized images in turn, so
+    // the image being painted is not overwritten by the next frame.
+    BufferedImage[] buffers = new BufferedImage[2];
+    int next = 0;
+    // Updates that were decoded but not shown because a newer one was waiting.
+    volatile int dropped = 0;
+
+    public DrawScreen(BlockingQueue<ScreenFrame> frames, BlockingQueue<ScreenFrame> free, ScreenPanel p) {
+        this.frames = frames;
+        this.free = free;
+        cPanel = p;
+        // Decode from memory instead of spooling every frame through a temp file,
+        // and keep one JPEG reader for the whole session.
+        ImageIO.setUseCache(false);
+        reader = ImageIO.getImageReadersByFormatName("jpeg").next();
+        param = reader.getDefaultReadParam();
+        start();
+    }
 
-                Graphics graphics = cPanel.getGraphics();
-                graphics.drawImage(image1, 0, 0, cPanel.getWidth(), cPanel.getHeight(), cPanel);
+    public void run() {
+        try {
+            while (continueLoop) {
+                ScreenFrame frame = frames.take();
+                Dimension size = cPanel.size;
+
+                // Update layout: full-frame flag, screen width and height and the
+                // tile count, then per tile x, y, width, height, JPEG length and JPEG.
+                ByteBuffer update = ByteBuffer.wrap(frame.data, 0, frame.length);
+                update.get();
+                int width = update.getInt();
+                int height = update.getInt();
+                if (screen == null || screen.getWidth() != width || screen.getHeight() != height) {
+                    screen = new BufferedImage(width, height, BufferedImage.TYPE_INT_RGB);
+                }
+                // Strips vary in width, so they are all decoded into the top left of
+                // one full-width image rather than an image of their own size.
+                if (image1 == null || image1.getWidth() != width) {
+                    image1 = new BufferedImage(width, TILE, BufferedImage.TYPE_3BYTE_BGR);
+                    param.setDestination(image1);
+                }
+
+                Graphics2D g = screen.createGraphics();
+                for (int tiles = update.getInt(); tiles > 0; tiles--) {
+                    int x = update.getShort();
+                    int y = update.getShort();
+                    int w = update.getShort();
+                    int h = update.getShort();
+                    int length = update.getInt();
+                    tile.set(frame.data, update.position(), length);
+                    update.position(update.position() + length);
+
+                    reader.setInput(tile, true, true);
+                    reader.read(0, param);
+                    g.drawImage(image1, x, y, x + w, y + h, 0, 0, w, h, null);
+                }
+                g.dispose();
+                free.offer(frame);
+
+                // Every update is patched in, but only the newest is scaled and shown.
+                if (frames.isEmpty()) {
+                    cPanel.setImage(stage(screen, size));
+                } else {
+                    dropped++;
+                }
             }
 
         } catch (IOException ex) {
             ex.printStackTrace();
+        } catch (InterruptedException ex) {
+            ex.printStackTrace();
+        }
+    }
+
+    // Scales the decoded frame to the panel size in the screen's pixel format,
+    // so the Swing thread only has to copy it.
+    private BufferedImage stage(BufferedImage decoded, Dimension size) {
+        int w = size.width;
+        int h = size.height;
+        if (w <= 0 || h <= 0) {
+            return decoded;
+        }
+
+        BufferedImage target = buffers[next];
+        if (target == null || target.getWidth() != w || target.getHeight() != h) {
+            GraphicsConfiguration gc = cPanel.getGraphicsConfiguration();
+            target = gc != null ? gc.createCompatibleImage(w, h) : new BufferedImage(w, h, BufferedImage.TYPE_INT_RGB);
+            buffers[next] = target;
+        }
+        next = 1 - next;
+
+        Graphics2D g = target.createGraphics();
+        g.setRenderingHint(RenderingHints.KEY_INTERPOLATION, RenderingHints.VALUE_INTERPOLATION_BILINEAR);
+        g.drawImage(decoded, 0, 0, w, h, null);
+        g.dispose();
+        return target;
+    }
+}
+
+class ScreenFrame {
+    byte[] data = new byte[256 * 1024];
+    int length = 0;
+}
+
+// ImageInputStream over a slice of a byte array. Unlike the stream ImageIO
+// creates, it does not copy the data and is reused for every tile.
+class TileInputStream extends ImageInputStreamImpl {
+    private byte[] data = null;
+    private int offset = 0;
+    private int length = 0;
+
+    public void set(byte[] data, int offset, int length) {
+        this.data = data;
+        this.offset = offset;
+        this.length = length;
+        streamPos = 0;
+        flushedPos = 0;
+        bitOffset = 0;
+    }
+
+    public int read() throws IOException {
+        bitOffset = 0;
+        if (streamPos >= length) {
+            return -1;
+        }
+        return data[offset + (int) streamPos++] & 0xff;
+    }
+
+    public int read(byte[] b, int off, int len) throws IOException {
+        bitOffset = 0;
+        if (len == 0) {
+            return 0;
+        }
+        int count = (int) Math.min(len, length - streamPos);
+        if (count <= 0) {
+            return -1;
+        }
+        System.arraycopy(data, offset + (int) streamPos, b, off, count);
+        streamPos += count;
+        return count;
+    }
+
+    public long length() {
+        return length;
+    }
+}
+
+class ScreenPanel extends JPanel {
+    private volatile BufferedImage image = null;
+    volatile int frames = 0;
+    // Size as of the last resize, read by DrawScreen instead of querying
+    // the component from outside the Swing thread on every frame.
+    volatile Dimension size = new Dimension(0, 0);
+
+    ScreenPanel() {
+        addComponentListener(new ComponentAdapter() {
+            public void componentResized(ComponentEvent e) {
+                size = getSize();
+            }
+        });
+    }
+
+    // Swaps in the newest frame; Swing merges pending repaints, so the panel
+    // is redrawn at most once per paint cycle.
+    public void setImage(BufferedImage image) {
+        this.image = image;
+        frames++;
+        repaint();
+    }
+
+    protected void paintComponent(Graphics g) {
+        BufferedImage current = image;
+        if (current == null) {
+            super.paintComponent(g);
+            return;
         }
+
+        // Frames are already staged at panel size; scaling only happens for
+        // the frame that is showing while the panel is being resized.
+        Graphics2D g2 = (Graphics2D) g;
+        g2.setRenderingHint(RenderingHints.KEY_INTERPOLATION, RenderingHints.VALUE_INTERPOLATION_BILINEAR);
+        g2.drawImage(current, 0, 0, getWidth(), getHeight(), null);
     }
 }
 
-class SendEvents implements KeyListener, MouseMotionListener, MouseListener {
+class SendEvents implements KeyListener, MouseMotionListener, MouseListener, Runnable {
     private Socket cSocket = null;
     private JPanel cPanel = null;
-    private PrintWriter writer = null;
+    private DataOutputStream writer = null;
+    // Events are written on the Swing thread and flushed once that thread has
+    // handled everything already queued, so a burst goes out in one write.
+    private boolean flushPending = false;
+    // Only the newest mouse position matters, so a move waits here and is
+    // replaced by later moves until another event or the flush writes it.
+    private boolean movePending = false;
+    private int moveX = -1;
+    private int moveY = -1;
+    // Set after the first failed write; later events are dropped without
+    // touching the socket or printing again.
+    private boolean closed = false;
     String width = "", height = "";
     double w;
     double h;
+    // Panel-to-remote scale, updated when the panel is resized rather than
+    // recomputed for every mouse move. The first value is computed on the
+    // CreateFrame thread, hence volatile.
+    volatile double xScale = 1;
+    volatile double yScale = 1;
 
     SendEvents(Socket s, JPanel p, String width, String height) {
         cSocket = s;
@@ -218,16 +529,98 @@ class SendEvents implements KeyListener, MouseMotionListener, MouseListener {
         this.width = width;
         this.height = height;
         w = Double.valueOf(width.trim()).doubleValue();
-        h = Double.valueOf(width.trim()).doubleValue();
+        h = Double.valueOf(height.trim()).doubleValue();
 
+        // Listen first, so a resize during layout cannot fall between the
+        // initial computation and the listener.
+        cPanel.addComponentListener(new ComponentAdapter() {
+            public void componentResized(ComponentEvent e) {
+                updateScale();
+            }
+        });
+        updateScale();
         cPanel.addKeyListener(this);
         cPanel.addMouseListener(this);
         cPanel.addMouseMotionListener(this);
 
         try {
-            writer = new PrintWriter(cSocket.getOutputStream());
+            // Commands and their arguments go out as 4-byte ints, one flush per event.
+            writer = new DataOutputStream(new BufferedOutputStream(cSocket.getOutputStream()));
         } catch (IOException ex) {
             ex.printStackTrace();
+            closed = true;
+        }
+    }
+
+    private void updateScale() {
+        if (cPanel.getWidth() > 0 && cPanel.getHeight() > 0) {
+            xScale = w / cPanel.getWidth();
+            yScale = h / cPanel.getHeight();
+        }
+    }
+
+    public void sendQuality(int quality) {
+        send(Commands.SET_QUALITY.getAbbrev(), quality);
+    }
+
+    private void send(int command, int value) {
+        if (closed) {
+            return;
+        }
+        try {
+            writeMove();
+            writer.writeInt(command);
+            writer.writeInt(value);
+            flushLater();
+        } catch (IOException ex) {
+            failed(ex);
+        }
+    }
+
+    private void failed(IOException ex) {
+        closed = true;
+        System.out.println("Event connection closed: " + ex.getMessage());
+    }
+
+    private void move(int x, int y) {
+        // When the panel is larger than the remote screen, several panel pixels
+        // map to one remote position; moving there again changes nothing.
+        if (closed || (x == moveX && y == moveY)) {
+            return;
+        }
+        moveX = x;
+        moveY = y;
+        movePending = true;
+        flushLater();
+    }
+
+    private void writeMove() throws IOException {
+        if (movePending) {
+            movePending = false;
+            writer.writeInt(Commands.MOVE_MOUSE.getAbbrev());
+            writer.writeInt(moveX);
+            writer.writeInt(moveY);
+        }
+    }
+
+    private void flushLater() {
+        if (!flushPending) {
+            flushPending = true;
+            SwingUtilities.invokeLater(this);
+        }
+    }
+
+    // Runs on the Swing thread after the events queued before it.
+    public void run() {
+        flushPending = false;
+        if (closed) {
+            return;
+        }
+        try {
+            writeMove();
+            writer.flush();
+        } catch (IOException ex) {
+            failed(ex);
         }
     }
 
@@ -235,37 +628,38 @@ class SendEvents implements KeyListener, MouseMotionListener, MouseListener {
     }
 
     public void mouseMoved(MouseEvent e) {
-        double xScale = (double) w / cPanel.getWidth();
-        double yScale = (double) h / cPanel.getHeight();
-        writer.println(Commands.MOVE_MOUSE.getAbbrev());
-        writer.println((int) (e.getX() * xScale));
-        writer.println((int) (e.getY() * yScale));
-        writer.flush();
+        move((int) (e.getX() * xScale), (int) (e.getY() * yScale));
     }
 
     public void mouseClicked(MouseEvent e) {
     }
 
     public void mousePressed(MouseEvent e) {
-        writer.println(Commands.PRESS_MOUSE.getAbbrev());
-        int button = e.getButton();
-        int xButton = 16;
-        if (button == 3) {
-            xButton = 4;
+        int mask = buttonMask(e);
+        if (mask != 0) {
+            send(Commands.PRESS_MOUSE.getAbbrev(), mask);
         }
-        writer.println(xButton);
-        writer.flush();
     }
 
     public void mouseReleased(MouseEvent e) {
-        writer.println(Commands.RELEASE_MOUSE.getAbbrev());
+        int mask = buttonMask(e);
+        if (mask != 0) {
+            send(Commands.RELEASE_MOUSE.getAbbrev(), mask);
+        }
+    }
+
+    // Robot button mask for the event, or 0 for events without a button or with
+    // an extra button getMaskForButton does not support.
+    private int buttonMask(MouseEvent e) {
         int button = e.getButton();
-        int xButton = 16;
-        if (button == 3) {
-            xButton = 4;
+        if (button == MouseEvent.NOBUTTON) {
+            return 0;
+        }
+        try {
+            return InputEvent.getMaskForButton(button);
+        } catch (IllegalArgumentException ex) {
+            return 0;
         }
-        writer.println(xButton);
-        writer.flush();
     }
 
     public void mouseEntered(MouseEvent e) {
@@ -278,14 +672,17 @@ class SendEvents implements KeyListener, MouseMotionListener, MouseListener {
     }
 
     public void keyPressed(KeyEvent e) {
-        writer.println(Commands.PRESS_KEY.getAbbrev());
-        writer.println(e.getKeyCode());
-        writer.flush();
+        // Keys Java has no code for cannot be replayed by the server's Robot.
+        if (e.getKeyCode() == KeyEvent.VK_UNDEFINED) {
+            return;
+        }
+        send(Commands.PRESS_KEY.getAbbrev(), e.getKeyCode());
     }
 
     public void keyReleased(KeyEvent e) {
-        writer.println(Commands.RELEASE_KEY.getAbbrev());
-        writer.println(e.getKeyCode());
-        writer.flush();
+        if (e.getKeyCode() == KeyEvent.VK_UNDEFINED) {
+            return;
+        }
+        send(Commands.RELEASE_KEY.getAbbrev(), e.getKeyCode());
     }
 }
\ No newline at end of file
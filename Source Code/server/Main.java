@@ -4,11 +4,37 @@ import java.awt.*;
 import java.awt.Rectangle;
 import java.awt.Robot;
 import java.awt.image.BufferedImage;
+import java.awt.image.DataBuffer;
+import java.awt.image.DataBufferInt;
+import java.io.BufferedInputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.EOFException;
 import java.io.IOException;
 import java.io.OutputStream;
+import java.io.UTFDataFormatException;
 import java.net.Socket;
+import java.net.SocketTimeoutException;
+import java.security.GeneralSecurityException;
+import java.security.MessageDigest;
+import java.security.SecureRandom;
+import javax.crypto.SecretKeyFactory;
+import javax.crypto.spec.PBEKeySpec;
+import javax.imageio.IIOImage;
 import javax.imageio.ImageIO;
-import java.util.Scanner;
+import javax.imageio.ImageWriteParam;
+import javax.imageio.ImageWriter;
+import javax.imageio.stream.ImageOutputStream;
+import java.util.ArrayDeque;
+import java.util.HashMap;
+import java.util.Iterator;
+import java.util.concurrent.ArrayBlockingQueue;
+import java.util.concurrent.BlockingQueue;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.TimeUnit;
+import java.util.concurrent.atomic.AtomicBoolean;
+import java.net.InetAddress;
 import java.net.ServerSocket;
 import java.net.Socket;
 import java.io.DataInputStream;
@@ -53,20 +79,56 @@ public class Main extends JFrame implements ActionListener {
     }
 
     public static void main(String[] args) {
-        new Main();
+        // Swing components are built on the event thread.
+        SwingUtilities.invokeLater(new Runnable() {
+            public void run() {
+                new Main();
+            }
+        });
     }
 }
 
-class InitConnection {
+class InitConnection extends Thread {
     ServerSocket socket = null;
-    DataInputStream password = null;
-    DataOutputStream verify = null;
+    Robot robot = null;
+    Rectangle rectangle = null;
     String width = "";
     String height = "";
+    int port = 0;
+    // Salted PBKDF2 hash of the password set in the GUI. The slow hash makes
+    // every guess expensive for a client trying passwords.
+    static final int HASH_ITERATIONS = 65536;
+    byte[] salt = new byte[16];
+    byte[] passwordHash = null;
+    // Times of recent failed logins per client address. An address with
+    // MAX_FAILED_ATTEMPTS failures inside LOCKOUT_MILLIS is refused without hashing.
+    static final int MAX_FAILED_ATTEMPTS = 5;
+    static final long LOCKOUT_MILLIS = 60 * 1000;
+    HashMap<InetAddress, ArrayDeque<Long>> failedAttempts = new HashMap<InetAddress, ArrayDeque<Long>>();
+    long lastSweep = 0;
+    // Login replies, encoded once.
+    byte[] accepted = null;
+    byte[] rejected = null;
+    // Logins are checked on these threads so a slow client or the password hash
+    // never holds up accept().
+    static final int HANDSHAKE_THREADS = 4;
+    ExecutorService handshakes = Executors.newFixedThreadPool(HANDSHAKE_THREADS);
+    // A client gets this long after connecting to send its password, which may be
+    // at most MAX_PASSWORD_BYTES long once encoded. The viewer connects only once
+    // the password has been entered.
+    static final int LOGIN_TIMEOUT_MILLIS = 10 * 1000;
+    static final int MAX_PASSWORD_BYTES = 256;
 
     InitConnection(int port, String value1) {
-        Robot robot = null;
-        Rectangle rectangle = null;
+        this.port = port;
+        new SecureRandom().nextBytes(salt);
+        passwordHash = hash(value1);
+        // Accepting clients blocks, so it runs here rather than on the Swing thread
+        // that called the constructor.
+        start();
+    }
+
+    public void run() {
         try {
             System.out.println("Awaiting Connection from Client");
             socket = new ServerSocket(port);
@@ -80,104 +142,508 @@ class InitConnection {
             rectangle = new Rectangle(dim);
             robot = new Robot(gDev);
 
+            // The replies never change, so they are encoded once and each sent
+            // as a single write.
+            ByteArrayOutputStream reply = new ByteArrayOutputStream();
+            DataOutputStream replyOut = new DataOutputStream(reply);
+            replyOut.writeUTF("valid");
+            replyOut.writeUTF(width);
+            replyOut.writeUTF(height);
+            accepted = reply.toByteArray();
+            reply.reset();
+            replyOut.writeUTF("Invalid");
+            rejected = reply.toByteArray();
+
             while (true) {
-                Socket sc = socket.accept();
-                password = new DataInputStream(sc.getInputStream());
-                verify = new DataOutputStream(sc.getOutputStream());
-                String pssword = password.readUTF();
-
-                if (pssword.equals(value1)) {
-                    verify.writeUTF("valid");
-                    verify.writeUTF(width);
-                    verify.writeUTF(height);
-                    new SendScreen(sc, robot, rectangle);
-                    new ReceiveEvents(sc, robot);
-                } else {
-                    verify.writeUTF("Invalid");
-                }
+                final Socket sc = socket.accept();
+                handshakes.execute(new Runnable() {
+                    public void run() {
+                        authenticate(sc);
+                    }
+                });
             }
         } catch (Exception ex) {
             ex.printStackTrace();
         }
     }
+
+    void authenticate(Socket sc) {
+        try {
+            sc.setSoTimeout(LOGIN_TIMEOUT_MILLIS);
+            DataInputStream password = new DataInputStream(sc.getInputStream());
+            DataOutputStream verify = new DataOutputStream(sc.getOutputStream());
+            InetAddress address = sc.getInetAddress();
+
+            // A locked out address is turned away before anything is read; this
+            // does not count as another failure, so the lockout still runs out.
+            if (!isAllowed(address)) {
+                reject(sc, password, verify);
+                return;
+            }
+
+            // The password comes as writeUTF data; its length is checked before
+            // anything is read or decoded.
+            int length = password.readUnsignedShort();
+            if (length > MAX_PASSWORD_BYTES) {
+                recordFailure(address);
+                reject(sc, password, verify);
+                return;
+            }
+            byte[] utf = new byte[2 + length];
+            utf[0] = (byte) (length >>> 8);
+            utf[1] = (byte) length;
+            password.readFully(utf, 2, length);
+            String pssword = null;
+            try {
+                pssword = DataInputStream.readUTF(new DataInputStream(new ByteArrayInputStream(utf)));
+            } catch (UTFDataFormatException ex) {
+                // Malformed bytes count as a failed guess like any other.
+                recordFailure(address);
+                reject(sc, password, verify);
+                return;
+            }
+
+            // Compares every byte regardless of where they differ.
+            if (MessageDigest.isEqual(hash(pssword), passwordHash)) {
+                sc.setSoTimeout(0);
+                // Updates end in partial segments that Nagle would hold back until
+                // the client's delayed ACK, and a large send window keeps a burst
+                // of tiles from blocking the capture loop.
+                sc.setTcpNoDelay(true);
+                sc.setSendBufferSize(4 * 1024 * 1024);
+                sc.setKeepAlive(true);
+                verify.write(accepted);
+                SendScreen screen = new SendScreen(sc, robot, rectangle);
+                new ReceiveEvents(sc, robot, screen);
+            } else {
+                recordFailure(address);
+                reject(sc, password, verify);
+            }
+        } catch (IOException ex) {
+            // A client that fails mid-login only loses its own connection. Timing
+            // out is routine, so it gets one line rather than a stack trace.
+            if (ex instanceof SocketTimeoutException) {
+                System.out.println("Login timed out for " + sc.getInetAddress());
+            } else {
+                ex.printStackTrace();
+            }
+            try {
+                sc.close();
+            } catch (IOException e) {
+                e.printStackTrace();
+            }
+        }
+    }
+
+    // Closing with unread input resets the connection, which can discard the
+    // reply before the client reads it; the reply is followed by a FIN and
+    // whatever has already arrived is skipped first.
+    void reject(Socket sc, DataInputStream in, DataOutputStream out) throws IOException {
+        out.write(rejected);
+        sc.shutdownOutput();
+        in.skip(in.available());
+        sc.close();
+    }
+
+    // Drops failures older than the lockout window from the front of the queue,
+    // then checks how many are left.
+    synchronized boolean isAllowed(InetAddress address) {
+        long now = System.currentTimeMillis();
+        if (now - lastSweep > LOCKOUT_MILLIS / 4) {
+            sweep(now);
+        }
+        ArrayDeque<Long> attempts = failedAttempts.get(address);
+        if (attempts == null) {
+            return true;
+        }
+        while (!attempts.isEmpty() && now - attempts.peekFirst() >= LOCKOUT_MILLIS) {
+            attempts.pollFirst();
+        }
+        if (attempts.isEmpty()) {
+            failedAttempts.remove(address);
+            return true;
+        }
+        return attempts.size() < MAX_FAILED_ATTEMPTS;
+    }
+
+    // Addresses that never come back would otherwise stay in the map forever.
+    // Drops every address whose newest failure is outside the lockout window.
+    void sweep(long now) {
+        Iterator<ArrayDeque<Long>> it = failedAttempts.values().iterator();
+        while (it.hasNext()) {
+            ArrayDeque<Long> attempts = it.next();
+            if (attempts.isEmpty() || now - attempts.peekLast() >= LOCKOUT_MILLIS) {
+                it.remove();
+            }
+        }
+        lastSweep = now;
+    }
+
+    synchronized void recordFailure(InetAddress address) {
+        ArrayDeque<Long> attempts = failedAttempts.get(address);
+        if (attempts == null) {
+            attempts = new ArrayDeque<Long>(MAX_FAILED_ATTEMPTS);
+            failedAttempts.put(address, attempts);
+        }
+        // Only the newest MAX_FAILED_ATTEMPTS matter for the lockout.
+        if (attempts.size() >= MAX_FAILED_ATTEMPTS) {
+            attempts.pollFirst();
+        }
+        attempts.addLast(System.currentTimeMillis());
+    }
+
+    byte[] hash(String password) {
+        PBEKeySpec spec = new PBEKeySpec(password.toCharArray(), salt, HASH_ITERATIONS, 256);
+        try {
+            return SecretKeyFactory.getInstance("PBKDF2WithHmacSHA256").generateSecret(spec).getEncoded();
+        } catch (GeneralSecurityException ex) {
+            throw new IllegalStateException(ex);
+        } finally {
+            spec.clearPassword();
+        }
+    }
 }
 
 class SendScreen extends Thread {
     Socket socket = null;
     Robot robot = null;
     Rectangle rectangle = null;
-    boolean continueLoop = true;
-    OutputStream oos = null;
+    // Cleared by ReceiveEvents when the client goes away.
+    volatile boolean continueLoop = true;
+    OutputStream out = null;
+    ImageWriter writer = null;
+    ImageWriteParam param = null;
+    // JPEG quality in 0..1, lowered by the client when it cannot keep up.
+    volatile float quality = 0.75f;
+    // Below this quality the link is the bottleneck, so frames also go out at half size.
+    static final float HALF_SIZE_QUALITY = 0.4f;
+    BufferedImage half = null;
+    // Frames are split into TILE x TILE squares and only changed ones are sent.
+    static final int TILE = 64;
+    int[] previous = null;
+    int previousWidth = 0;
+    // Set when the client raises the quality. Unchanged tiles would keep the lower
+    // quality, so they are resent REFRESH_ROWS rows of tiles per update rather than
+    // in one full frame, which would push a client near its limit straight back down.
+    AtomicBoolean refresh = new AtomicBoolean(false);
+    static final int REFRESH_ROWS = 2;
+    // First tile row of the next rows to resend, or -1 when none are due.
+    int refreshRow = -1;
+    ByteArrayOutputStream jpeg = new ByteArrayOutputStream();
+    // Reused for every update; it keeps the capacity of the largest one so far.
+    UpdateBuffer tiles = new UpdateBuffer();
+    DataOutputStream tilesOut = new DataOutputStream(tiles);
+    CaptureScreen capture = null;
 
     public SendScreen(Socket socket, Robot robot, Rectangle rect) {
         this.socket = socket;
         this.robot = robot;
         rectangle = rect;
+        // Without this, every tile is encoded through a temporary file.
+        ImageIO.setUseCache(false);
+        writer = ImageIO.getImageWritersByFormatName("jpeg").next();
+        param = writer.getDefaultWriteParam();
+        param.setCompressionMode(ImageWriteParam.MODE_EXPLICIT);
         start();
     }
 
     public void run() {
         try {
-            oos = socket.getOutputStream();
+            // Each update is handed over in one write, so no extra buffering is needed.
+            out = socket.getOutputStream();
         } catch (IOException ex) {
             ex.printStackTrace();
+            return;
         }
+        capture = new CaptureScreen(robot, rectangle);
 
         while (continueLoop) {
-            BufferedImage image = robot.createScreenCapture(rectangle);
+            BufferedImage image = null;
+            try {
+                image = capture.frames.take();
+            } catch (InterruptedException e) {
+                // Stopped by ReceiveEvents.
+                break;
+            }
+            if (quality < HALF_SIZE_QUALITY) {
+                image = halve(image);
+            }
 
             try {
-                ImageIO.write(image, "jpeg", oos);
+                int width = image.getWidth();
+                int height = image.getHeight();
+                int[] pixels = pixels(image);
+                boolean full = previous == null || previous.length != pixels.length || previousWidth != width;
+                if (refresh.getAndSet(false)) {
+                    refreshRow = 0;
+                }
+                if (full) {
+                    refreshRow = -1;
+                }
+                param.setCompressionQuality(quality);
+
+                tiles.reset();
+                int count = 0;
+                for (int y = 0; y < height; y += TILE) {
+                    int h = Math.min(TILE, height - y);
+                    int row = y / TILE;
+                    boolean resend = full || (refreshRow >= 0 && row >= refreshRow && row < refreshRow + REFRESH_ROWS);
+                    // Changed tiles next to each other in a row go out as one JPEG,
+                    // which saves a set of JPEG headers and a decode per tile.
+                    int start = -1;
+                    for (int x = 0; x < width; x += TILE) {
+                        int w = Math.min(TILE, width - x);
+                        if (resend || changed(pixels, width, x, y, w, h)) {
+                            if (start < 0) {
+                                start = x;
+                            }
+                        } else if (start >= 0) {
+                            writeTile(tilesOut, image.getSubimage(start, y, x - start, h), start, y);
+                            count++;
+                            start = -1;
+                        }
+                    }
+                    if (start >= 0) {
+                        writeTile(tilesOut, image.getSubimage(start, y, width - start, h), start, y);
+                        count++;
+                    }
+                }
+                if (image == half) {
+                    // half is drawn over by the next frame, so it needs a copy.
+                    if (previous == null || previous.length != pixels.length) {
+                        previous = new int[pixels.length];
+                    }
+                    System.arraycopy(pixels, 0, previous, 0, pixels.length);
+                } else {
+                    // Each capture is a new image, so its array can be kept as is.
+                    previous = pixels;
+                }
+                previousWidth = width;
+                if (refreshRow >= 0) {
+                    refreshRow += REFRESH_ROWS;
+                    if (refreshRow * TILE >= height) {
+                        refreshRow = -1;
+                    }
+                }
+
+                if (count > 0) {
+                    tiles.send(out, full, width, height, count);
+                }
             } catch (IOException ex) {
-                ex.printStackTrace();
+                // The client is gone; stop instead of failing again every frame.
+                System.out.println("Screen connection closed: " + ex.getMessage());
+                continueLoop = false;
             }
+        }
+        capture.continueLoop = false;
+        capture.interrupt();
+    }
 
-            try {
-                Thread.sleep(10);
-            } catch (InterruptedException e) {
-                e.printStackTrace();
+    // The image's own pixel array when it is a plain RGB raster, which is what
+    // Robot returns; getRGB would convert and copy every pixel.
+    private int[] pixels(BufferedImage image) {
+        DataBuffer buffer = image.getRaster().getDataBuffer();
+        if (image.getType() == BufferedImage.TYPE_INT_RGB && buffer instanceof DataBufferInt
+                && buffer.getSize() == image.getWidth() * image.getHeight()) {
+            return ((DataBufferInt) buffer).getData();
+        }
+        return image.getRGB(0, 0, image.getWidth(), image.getHeight(), null, 0, image.getWidth());
+    }
+
+    // True if any pixel of the tile differs from the last frame that was sent.
+    private boolean changed(int[] pixels, int width, int x, int y, int w, int h) {
+        for (int row = y; row < y + h; row++) {
+            int start = row * width + x;
+            for (int i = start; i < start + w; i++) {
+                if (pixels[i] != previous[i]) {
+                    return true;
+                }
             }
         }
+        return false;
+    }
+
+    // Tile layout: x, y, width and height as shorts, the JPEG length, then the JPEG.
+    private void writeTile(DataOutputStream out, BufferedImage tile, int x, int y) throws IOException {
+        jpeg.reset();
+        ImageOutputStream ios = ImageIO.createImageOutputStream(jpeg);
+        writer.setOutput(ios);
+        writer.write(null, new IIOImage(tile, null, null), param);
+        ios.close();
+
+        out.writeShort(x);
+        out.writeShort(y);
+        out.writeShort(tile.getWidth());
+        out.writeShort(tile.getHeight());
+        out.writeInt(jpeg.size());
+        jpeg.writeTo(out);
+    }
+
+    // Bilinear at exactly 1/2 averages each 2x2 block into one pixel.
+    private BufferedImage halve(BufferedImage image) {
+        int w = image.getWidth() / 2;
+        int h = image.getHeight() / 2;
+        if (half == null || half.getWidth() != w || half.getHeight() != h) {
+            half = new BufferedImage(w, h, BufferedImage.TYPE_INT_RGB);
+        }
+
+        Graphics2D g = half.createGraphics();
+        g.setRenderingHint(RenderingHints.KEY_INTERPOLATION, RenderingHints.VALUE_INTERPOLATION_BILINEAR);
+        g.drawImage(image, 0, 0, w, h, null);
+        g.dispose();
+        return half;
+    }
+}
+
+// Takes the next screenshot while SendScreen is still encoding the last one.
+// The queue holds only the newest capture; an older one not yet taken is replaced.
+class CaptureScreen extends Thread {
+    // Captures start at most this often; a slow frame is followed at once.
+    static final long FRAME_NANOS = 1000000000L / 30;
+    Robot robot = null;
+    Rectangle rectangle = null;
+    volatile boolean continueLoop = true;
+    BlockingQueue<BufferedImage> frames = new ArrayBlockingQueue<BufferedImage>(1);
+
+    public CaptureScreen(Robot robot, Rectangle rect) {
+        this.robot = robot;
+        rectangle = rect;
+        start();
+    }
+
+    public void run() {
+        long last = System.nanoTime() - FRAME_NANOS;
+        try {
+            while (continueLoop) {
+                long wait = last + FRAME_NANOS - System.nanoTime();
+                if (wait > 0) {
+                    TimeUnit.NANOSECONDS.sleep(wait);
+                }
+                last = System.nanoTime();
+                BufferedImage image = robot.createScreenCapture(rectangle);
+                if (!frames.offer(image)) {
+                    frames.poll();
+                    frames.offer(image);
+                }
+            }
+        } catch (InterruptedException ex) {
+            // Stopped by SendScreen.
+        }
+    }
+}
+
+// Collects the tiles of one update behind room for its header, so the header
+// and tiles reach the socket in a single write.
+class UpdateBuffer extends ByteArrayOutputStream {
+    // Length prefix, full-frame flag, width, height and tile count.
+    static final int HEADER = 17;
+
+    UpdateBuffer() {
+        super(256 * 1024);
+        count = HEADER;
+    }
+
+    public void reset() {
+        count = HEADER;
+    }
+
+    public void send(OutputStream out, boolean full, int width, int height, int tiles) throws IOException {
+        // Length prefix lets the client read exactly one update.
+        putInt(0, count - 4);
+        buf[4] = (byte) (full ? 1 : 0);
+        putInt(5, width);
+        putInt(9, height);
+        putInt(13, tiles);
+        out.write(buf, 0, count);
+    }
+
+    private void putInt(int offset, int value) {
+        buf[offset] = (byte) (value >>> 24);
+        buf[offset + 1] = (byte) (value >>> 16);
+        buf[offset + 2] = (byte) (value >>> 8);
+        buf[offset + 3] = (byte) value;
     }
 }
 
 class ReceiveEvents extends Thread {
     Socket socket = null;
     Robot robot = null;
+    SendScreen screen = null;
     boolean continueLoop = true;
 
-    public ReceiveEvents(Socket socket, Robot robot) {
+    public ReceiveEvents(Socket socket, Robot robot, SendScreen screen) {
         this.socket = socket;
         this.robot = robot;
+        this.screen = screen;
         start();
     }
 
     public void run() {
-        Scanner scanner = null;
+        DataInputStream in = null;
         try {
-            scanner = new Scanner(socket.getInputStream());
+            // Each command and argument is a 4-byte int. Buffered so readInt does
+            // not read the socket one byte at a time.
+            in = new DataInputStream(new BufferedInputStream(socket.getInputStream()));
             while (continueLoop) {
-                int command = scanner.nextInt();
-                switch (command) {
-                    case -1:
-                        robot.mousePress(scanner.nextInt());
-                        break;
-                    case -2:
-                        robot.mouseRelease(scanner.nextInt());
-                        break;
-                    case -3:
-                        robot.keyPress(scanner.nextInt());
-                        break;
-                    case -4:
-                        robot.keyRelease(scanner.nextInt());
-                        break;
-                    case -5:
-                        robot.mouseMove(scanner.nextInt(), scanner.nextInt());
-                        break;
+                int command = in.readInt();
+                // Robot rejects key codes and buttons it cannot generate; skip
+                // that event rather than ending the session.
+                try {
+                    switch (command) {
+                        case -1:
+                            robot.mousePress(in.readInt());
+                            break;
+                        case -2:
+                            robot.mouseRelease(in.readInt());
+                            break;
+                        case -3:
+                            robot.keyPress(in.readInt());
+                            break;
+                        case -4:
+                            robot.keyRelease(in.readInt());
+                            break;
+                        case -5:
+                            int x = in.readInt();
+                            int y = in.readInt();
+                            // Moves already waiting right behind this one replace it,
+                            // so a backlog is not replayed point by point.
+                            while (in.available() >= 12) {
+                                in.mark(4);
+                                if (in.readInt() != -5) {
+                                    in.reset();
+                                    break;
+                                }
+                                x = in.readInt();
+                                y = in.readInt();
+                            }
+                            robot.mouseMove(x, y);
+                            break;
+                        case -6:
+                            float requested = Math.max(10, Math.min(100, in.readInt())) / 100f;
+                            if (requested > screen.quality) {
+                                screen.refresh.set(true);
+                            }
+                            screen.quality = requested;
+                            break;
+                    }
+                } catch (IllegalArgumentException ex) {
+                    System.out.println("Ignored event " + command + ": " + ex.getMessage());
                 }
             }
+        } catch (EOFException ex) {
+            // Client closed the connection.
         } catch (IOException ex) {
             ex.printStackTrace();
+        } finally {
+            // SendScreen only writes when the screen changes, so on an idle screen
+            // it would not notice the client is gone; stop it here.
+            screen.continueLoop = false;
+            screen.interrupt();
+            try {
+                socket.close();
+            } catch (IOException ex) {
+                ex.printStackTrace();
+            }
         }
     }
 }